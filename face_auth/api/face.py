@@ -1,11 +1,113 @@
-import frappe
 import os
-import face_recognition
+
+# Each gunicorn worker handles one request at a time; a BLAS pool per worker sized to
+# all cores oversubscribes the CPU. Must be set before numpy/dlib load their BLAS.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+import frappe
+from frappe import _
+import base64
+import io
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+from itertools import groupby
 import numpy as np
-from PIL import Image, ExifTags
+from PIL import Image, ImageOps
 import math
 from datetime import datetime, timedelta
-from frappe.desk.form.load import get_attachments
+from zoneinfo import ZoneInfo
+from frappe.utils import cint, get_system_timezone
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+# Maximum face distance for two encodings to be considered the same person
+FACE_MATCH_TOLERANCE = 0.5
+
+# Longest side of stored reference images; uploads are downscaled to this on load
+IMAGE_MAX_SIZE = 1200
+
+# Longest side of the image handed to face detection; a selfie face stays well above 200px
+DETECTION_MAX_SIZE = 800
+
+# dlib's detector first scans every DETECTION_STEP-th pixel, i.e. a 400px image for an 800px
+# upload, which finds a typical selfie face. Only if that finds nothing is the copy upsampled
+# once, so faces down to HOG's 80px minimum of the detection image are still found.
+DETECTION_STEP = 2
+
+# dlib and face_recognition are imported on first use by load_face_recognition, so
+# workers only serving the location endpoints never load them
+dlib = None
+face_recognition = None
+
+# OpenCV is optional and likewise imported on first use, by load_opencv
+# (False once it is known not to be installed)
+cv2 = None
+
+# Use the CNN face detector when dlib is built with CUDA, HOG on CPU-only builds
+# (set by load_face_recognition)
+FACE_DETECTION_MODEL = None
+
+# OpenCV ResNet-SSD face detector, used instead of dlib's when its model files are configured
+SSD_INPUT_SIZE = (300, 300)
+SSD_MEAN = (104.0, 177.0, 123.0)
+SSD_CONFIDENCE = 0.5
+# (False once loading the configured model files has failed)
+ssd_face_net = None
+
+# 5-point landmarks are enough to align the face for encoding and much cheaper than 68-point.
+# Sites can opt back into the 68-point model with the `face_encoding_model` config ("large").
+FACE_LANDMARK_MODEL = "small"
+
+# Accepted matches whose distance falls within this margin below FACE_MATCH_TOLERANCE must
+# also match with the 68-point landmarks on both images, so the cheaper model never decides
+# a borderline accept on its own
+FACE_MATCH_STRICT_MARGIN = 0.05
+
+# Micro-batching of face encodings across concurrent requests of a worker
+ENCODING_BATCH_SIZE = 16
+ENCODING_BATCH_WINDOW = 0.02  # seconds to wait for more requests before encoding
+ENCODING_TIMEOUT = 5  # seconds
+
+# How long the result of a background register_face/update_face stays available
+FACE_JOB_RESULT_TTL = 3600  # seconds
+
+# Office coordinates are read from Redis on check-in; Employee on_update clears them
+OFFICE_COORDINATES_CACHE_TTL = 3600  # seconds
+# ...and kept in process for a short while on top, so repeated check-ins skip Redis too.
+# Other workers only see an Employee change once this expires.
+OFFICE_COORDINATES_LOCAL_TTL = 60  # seconds
+OFFICE_COORDINATES_LOCAL_MAX = 4096  # entries
+
+# Check-ins whose approximate distance is off the geofence radius by more than this
+# factor either way are decided without computing the exact Haversine distance
+GEOFENCE_PREFILTER_MARGIN = 1.01
+
+# A tracking ping repeating the employee's last point (squared degree delta below the
+# threshold, about 3 m) within the window is dropped instead of stored
+LOCATION_DEDUP_THRESHOLD = 1e-9
+LOCATION_DEDUP_WINDOW = 30  # seconds
+
+# Most points track_locations_bulk accepts in one request
+LOCATION_BULK_MAX_POINTS = 1000
+
+# Longest path returned per employee by the historical path endpoints; longer paths are
+# thinned to every Nth point, which draws the same trace on the map
+HISTORICAL_PATH_MAX_POINTS = 5000
+
+# Rows returned per employee path by the database (about 14 hours of 1 Hz pings). Longer
+# paths are thinned evenly in the query, so the whole shift is still drawn, end included
+HISTORICAL_PATH_MAX_ROWS = 50000
+
+# All-employee get_latest_locations results are shared between dashboard polls for this long
+LATEST_LOCATIONS_CACHE_TTL = 5  # seconds
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """
@@ -13,88 +115,475 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     on the earth (specified in decimal degrees)
     """
     # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    lat1 = math.radians(lat1)
+    lon1 = math.radians(lon1)
+    lat2 = math.radians(lat2)
+    lon2 = math.radians(lon2)
     
     # Haversine formula
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a)) 
-    r = 6371  # Radius of earth in kilometers
-    return c * r  # Distance in kilometers
+    sin_dlat = math.sin((lat2 - lat1) * 0.5)
+    sin_dlon = math.sin((lon2 - lon1) * 0.5)
+    a = sin_dlat * sin_dlat + math.cos(lat1) * math.cos(lat2) * sin_dlon * sin_dlon
+    c = 2 * math.asin(min(1.0, math.sqrt(a)))
+    return c * 6371  # Radius of earth in kilometers; distance in kilometers
+
+def approximate_distance(lat1, lon1, lat2, lon2):
+    """
+    Equirectangular approximation of calculate_distance in kilometers: a single
+    cos() instead of the Haversine's trig calls. Within a fraction of a percent
+    at city scale, so it decides points clearly inside or outside a geofence.
+    """
+    # Wrap the longitude difference into [-180, 180] so points across the antimeridian stay close
+    dlon = (lon2 - lon1 + 180) % 360 - 180
+    x = math.radians(dlon) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371 * math.sqrt(x * x + y * y)
+
+def get_office_coordinates_cache_key(employee_id):
+    return f"face_auth:office_coords:{employee_id}"
+
+# (site, employee_id) -> (expires_at, coordinates)
+office_coordinates = {}
+
+def clear_office_coordinates_cache(doc, method=None):
+    """Employee on_update hook - drop the cached office coordinates"""
+    office_coordinates.pop((frappe.local.site, doc.name), None)
+    frappe.cache().delete_value(get_office_coordinates_cache_key(doc.name))
+
+def cache_office_coordinates_locally(employee_id, coordinates):
+    if len(office_coordinates) >= OFFICE_COORDINATES_LOCAL_MAX:
+        office_coordinates.clear()
+    office_coordinates[(frappe.local.site, employee_id)] = (
+        time.monotonic() + OFFICE_COORDINATES_LOCAL_TTL, coordinates
+    )
 
 def get_office_coordinates(employee_id):
     """Get office coordinates from Employee document"""
+    local = office_coordinates.get((frappe.local.site, employee_id))
+    if local and local[0] > time.monotonic():
+        return local[1]
+
+    cache_key = get_office_coordinates_cache_key(employee_id)
+    cached = frappe.cache().get_value(cache_key)
+    if cached:
+        cache_office_coordinates_locally(employee_id, tuple(cached))
+        return tuple(cached)
+
     try:
         # Assuming Employee doctype has fields: office_latitude, office_longitude, geofence_radius
-        employee = frappe.get_doc("Employee", employee_id)
+        # Read just these columns rather than loading the whole document
+        fields = ["office_latitude", "office_longitude"]
+        if frappe.get_meta("Employee").has_field("geofence_radius"):
+            fields.append("geofence_radius")
+        employee = frappe.db.get_value("Employee", employee_id, fields, as_dict=True) or {}
         office_lat = employee.get("office_latitude")
         office_long = employee.get("office_longitude")
-        geofence_radius = employee.get("geofence_radius", 0.5)  # Default to 0.5 km if not set
+        geofence_radius = employee.get("geofence_radius") or 0.5  # Default to 0.5 km if not set
          
         if not office_lat or not office_long:
             frappe.log_error(f"Office coordinates not set for employee {employee_id}", "Geofencing Error")
             return None, None, None
-            
-        return float(office_lat), float(office_long), float(geofence_radius)
+
+        coordinates = (float(office_lat), float(office_long), float(geofence_radius))
+        frappe.cache().set_value(cache_key, coordinates, expires_in_sec=OFFICE_COORDINATES_CACHE_TTL)
+        cache_office_coordinates_locally(employee_id, coordinates)
+        return coordinates
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), f"Error fetching office coordinates for {employee_id}")
         return None, None, None
 
-def correct_image_orientation(image_path):
-    """Correct image orientation using EXIF data and resize for optimal face detection"""
+def correct_image_orientation(img):
+    """
+    Correct image orientation using EXIF data and resize for optimal face detection.
+    Works on the PIL image in memory and returns the corrected RGB image.
+    """
+    # Resize large mobile images first; thumbnail keeps the aspect ratio and decimates
+    # with reduce() to within 2x of the target, so the final BILINEAR pass is as sharp as
+    # LANCZOS at a fraction of the cost (and uses JPEG draft mode when not yet loaded).
+    # The bounding box is square, so the size does not depend on the orientation.
+    max_size = IMAGE_MAX_SIZE
+    if max(img.size) > max_size:
+        # For a JPEG not decoded yet, let libjpeg decode at 1/2, 1/4 or 1/8 scale right away
+        img.draft("RGB", (max_size, max_size))
+        img.thumbnail((max_size, max_size), Image.BILINEAR, reducing_gap=2.0)
+
+    # Handle EXIF orientation, including the mirrored cases, on the downscaled image
+    ImageOps.exif_transpose(img, in_place=True)
+    
+    # Convert to RGB if needed
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    return img
+
+def load_reference_image(image_path):
+    """
+    Loads and corrects a stored reference image in memory, without rewriting it
+    on disk. Returns the RGB PIL image or None on failure.
+    """
     try:
-        img = Image.open(image_path)
-        
-        # Handle EXIF orientation
-        if hasattr(img, '_getexif'):
-            exif = img._getexif()
-            if exif:
-                for tag, value in ExifTags.TAGS.items():
-                    if value == 'Orientation':
-                        orientation = exif.get(tag)
-                        break
-                else:
-                    orientation = None
-
-                if orientation == 3:
-                    img = img.rotate(180, expand=True)
-                elif orientation == 6:
-                    img = img.rotate(270, expand=True)
-                elif orientation == 8:
-                    img = img.rotate(90, expand=True)
-        
-        # Resize large mobile images
-        max_size = 1200
-        if max(img.size) > max_size:
-            ratio = max_size / max(img.size)
-            new_size = (int(img.width * ratio), int(img.height * ratio))
-            img = img.resize(new_size, Image.LANCZOS)
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-            
-        # Save corrected image back to original path
-        img.save(image_path, "JPEG", quality=95, optimize=True)
-        return True
+        return correct_image_orientation(Image.open(image_path))
     except Exception as e:
         frappe.log_error(f"EXIF correction failed: {str(e)}", "Image Correction Error")
-        return False
+        return None
 
-def delete_existing_attachments(employee_id):
+def get_imread_flags(content):
     """
-    Deletes all existing attachments for the given Employee.
+    cv2.imdecode flags that decode the image at the smallest 1/2, 1/4 or 1/8
+    scale still at least IMAGE_MAX_SIZE on its longest side (DCT scaling for JPEGs).
+    """
+    try:
+        # Only parses the header
+        longest_side = max(Image.open(io.BytesIO(content)).size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+
+    for factor, flags in (
+        (8, cv2.IMREAD_REDUCED_COLOR_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2),
+    ):
+        if longest_side // factor >= IMAGE_MAX_SIZE:
+            return flags
+    return cv2.IMREAD_COLOR
+
+def load_uploaded_image(file):
+    """
+    Decodes an uploaded image straight from the request stream and corrects it,
+    without writing it to disk first. Returns the RGB PIL image or None on failure.
+    """
+    try:
+        if load_opencv() is not None:
+            # One read into a zero-copy uint8 view, decoded by OpenCV's libjpeg-turbo SIMD path.
+            # IMREAD_COLOR already applies the EXIF orientation.
+            content = file.stream.read()
+            decoded = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), get_imread_flags(content))
+            if decoded is None:
+                # A format OpenCV cannot read (e.g. GIF); let Pillow try it
+                return correct_image_orientation(Image.open(io.BytesIO(content)))
+            # Release the encoded upload before the decoded pixels are processed further
+            del content
+            # Swap BGR to RGB in place rather than allocating a second full-size array
+            cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB, dst=decoded)
+            return correct_image_orientation(Image.fromarray(decoded))
+
+        return correct_image_orientation(Image.open(file.stream))
+    except Exception as e:
+        frappe.log_error(f"EXIF correction failed: {str(e)}", "Image Correction Error")
+        return None
+
+def get_detection_image(img):
+    """
+    Returns the corrected PIL image as an RGB array for face detection, downscaled
+    so the longest side is at most DETECTION_MAX_SIZE. The stored image keeps its size.
+    """
+    width, height = img.size
+    if max(width, height) > DETECTION_MAX_SIZE:
+        # resize() writes straight into the new image instead of copying the full one first
+        scale = DETECTION_MAX_SIZE / max(width, height)
+        img = img.resize(
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            Image.BILINEAR
+        )
+    return np.array(img)
+
+def encode_jpeg(img):
+    """Returns the JPEG bytes for a corrected PIL image"""
+    buffer = io.BytesIO()
+    # Matching works on stored encodings, not on this file, so quality 85 with 4:2:0
+    # chroma subsampling is plenty; skip the extra Huffman optimization pass too
+    img.save(buffer, "JPEG", quality=85, subsampling=2, optimize=False, progressive=False)
+    return buffer.getvalue()
+
+def load_face_recognition():
+    """
+    Imports dlib and face_recognition once per worker, on the first face request.
+    Returns the face_recognition module.
+    """
+    global dlib, face_recognition, FACE_DETECTION_MODEL
+    if face_recognition is None:
+        import dlib as dlib_module
+        import face_recognition as face_recognition_module
+
+        dlib = dlib_module
+        FACE_DETECTION_MODEL = "cnn" if dlib.DLIB_USE_CUDA else "hog"
+        face_recognition = face_recognition_module
+    return face_recognition
+
+def load_opencv():
+    """Imports OpenCV once per worker. Returns the cv2 module, or None if it is not installed."""
+    global cv2
+    if cv2 is None:
+        try:
+            import cv2 as cv2_module
+            cv2 = cv2_module
+        except ImportError:
+            cv2 = False
+    return cv2 or None
+
+def load_ssd_face_net():
     """
+    Loads the OpenCV DNN ResNet-SSD face detector once per worker when opencv is
+    installed and `face_auth_ssd_model_dir` points at a folder containing
+    deploy.prototxt and res10_300x300_ssd_iter_140000.caffemodel.
+    """
+    global ssd_face_net
+    if ssd_face_net is not None or load_opencv() is None:
+        return ssd_face_net or None
+
+    model_dir = frappe.conf.get("face_auth_ssd_model_dir")
+    if not model_dir:
+        return None
+
     try:
-        # Get all attachments for the Employee
-        attachments = get_attachments("Employee", employee_id)
+        net = cv2.dnn.readNetFromCaffe(
+            os.path.join(model_dir, "deploy.prototxt"),
+            os.path.join(model_dir, "res10_300x300_ssd_iter_140000.caffemodel")
+        )
+        if dlib.DLIB_USE_CUDA:
+            net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+        else:
+            net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        ssd_face_net = net
+    except Exception as e:
+        # Remembered, so later requests use dlib instead of retrying and logging again
+        ssd_face_net = False
+        frappe.log_error(f"Loading SSD face detector failed: {str(e)}", "Face Detection Error")
+    return ssd_face_net or None
+
+def detect_faces(image):
+    """
+    Returns the (top, right, bottom, left) face locations in an RGB array.
+    Uses a single 300x300 forward pass of the SSD detector when it is loaded,
+    dlib's FACE_DETECTION_MODEL otherwise.
+    """
+    if not ssd_face_net:
+        # Locate the face on a half-resolution copy (a quarter of the pixels to scan) and
+        # scale the boxes back; encoding then only works on the face region of the full image
+        height, width = image.shape[:2]
+        small_image = np.ascontiguousarray(image[::DETECTION_STEP, ::DETECTION_STEP])
+        small_locations = face_recognition.face_locations(
+            small_image,
+            number_of_times_to_upsample=0,
+            model=FACE_DETECTION_MODEL
+        )
+        if not small_locations:
+            # Small face: upsampling the copy once restores the full-resolution minimum face size
+            small_locations = face_recognition.face_locations(
+                small_image,
+                number_of_times_to_upsample=1,
+                model=FACE_DETECTION_MODEL
+            )
+        return [
+            (
+                top * DETECTION_STEP,
+                min(width, right * DETECTION_STEP),
+                min(height, bottom * DETECTION_STEP),
+                left * DETECTION_STEP
+            )
+            for top, right, bottom, left in small_locations
+        ]
+
+    height, width = image.shape[:2]
+    # The Caffe model was trained on BGR input
+    blob = cv2.dnn.blobFromImage(
+        cv2.resize(image[:, :, ::-1], SSD_INPUT_SIZE), 1.0, SSD_INPUT_SIZE, SSD_MEAN
+    )
+    ssd_face_net.setInput(blob)
+    detections = ssd_face_net.forward()
+
+    face_locations = []
+    for confidence, left, top, right, bottom in detections[0, 0, :, 2:7]:
+        if confidence < SSD_CONFIDENCE:
+            continue
+        face_locations.append((
+            max(0, int(top * height)),
+            min(width, int(right * width)),
+            min(height, int(bottom * height)),
+            max(0, int(left * width))
+        ))
+    return face_locations
+
+def largest_face(face_locations):
+    """
+    Keeps only the largest detected face: the person in front of the camera.
+    Only one encoding is ever used, so encoding bystanders is wasted work.
+    """
+    if not face_locations:
+        return []
+    return [max(face_locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]))]
+
+# face_recognition keeps one dlib detector, shape predictor and face encoder per process
+# as module globals, and dlib does not document them as thread-safe. Every use goes
+# through this lock, so the batching thread and threaded request workers never share them.
+model_lock = threading.Lock()
+
+def batch_face_encodings(images, models):
+    """
+    Encodes the faces of several images with a single batched forward pass of
+    dlib's face recognition network, aligning each with its landmark model.
+    Returns one list of encodings per image.
+    """
+    results = [[] for _image in images]
+    with model_lock:
+        # face_recognition has no public batch encoder, so go through its dlib models directly
+        batch_landmarks = [
+            face_recognition.api._raw_face_landmarks(image, largest_face(detect_faces(image)), model=model)
+            for image, model in zip(images, models, strict=True)
+        ]
+        with_faces = [i for i, landmarks in enumerate(batch_landmarks) if len(landmarks)]
+        if not with_faces:
+            return results
+
+        descriptors = face_recognition.api.face_encoder.compute_face_descriptor(
+            [images[i] for i in with_faces],
+            [batch_landmarks[i] for i in with_faces],
+            1
+        )
+    for i, image_descriptors in zip(with_faces, descriptors, strict=True):
+        results[i] = [np.array(descriptor) for descriptor in image_descriptors]
+    return results
+
+class FaceEncodingBatcher:
+    """
+    Coalesces face encoding requests arriving within ENCODING_BATCH_WINDOW from
+    concurrent request threads into one batch_face_encodings call.
+    Only useful with threaded workers, enable with the `face_auth_batch_encoding` site config.
+    """
+    def __init__(self, batch_size=ENCODING_BATCH_SIZE, window=ENCODING_BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def submit(self, image, model=FACE_LANDMARK_MODEL):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+
+        future = Future()
+        self.pending.put((image, model, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = batch_face_encodings(
+                    [image for image, _model, _future in batch],
+                    [model for _image, model, _future in batch]
+                )
+            except Exception as e:
+                for _image, _model, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_image, _model, future), encodings in zip(batch, results, strict=True):
+                future.set_result(encodings)
+
+encoding_batcher = FaceEncodingBatcher()
+
+def encode_faces(image, model=FACE_LANDMARK_MODEL):
+    """
+    Detects faces (see detect_faces) and returns the 128-D encoding of the
+    largest one as a one-item list, or [] without running the encoder if there is no face.
+    """
+    with model_lock:
+        face_locations = largest_face(detect_faces(image))
+        if not face_locations:
+            return []
+        return face_recognition.face_encodings(
+            image,
+            known_face_locations=face_locations,
+            num_jitters=1,
+            model=model
+        )
+
+def get_face_encodings(image):
+    """
+    Returns the encoding of the largest face in the image as a one-item list, or [].
+    On a CUDA build of dlib both detection and embedding run on the GPU.
+    """
+    return get_face_encodings_for([image])[0]
+
+def get_face_encodings_for(images):
+    """
+    Encodes several images, returning one get_face_encodings result per image.
+    In one batch when batching is enabled, else one after another: dlib holds the
+    GIL during inference and its models are not thread-safe, so threads gain nothing.
+    """
+    load_face_recognition()
+    load_ssd_face_net()
+    model = frappe.conf.get("face_encoding_model") or FACE_LANDMARK_MODEL
+    if frappe.conf.get("face_auth_batch_encoding"):
+        futures = [encoding_batcher.submit(image, model) for image in images]
+        return [future.result(timeout=ENCODING_TIMEOUT) for future in futures]
 
-        for attachment in attachments:
-            # Delete the File document
-            file_doc = frappe.get_doc("File", attachment["name"])
-            file_doc.delete()
+    return [encode_faces(image, model) for image in images]
 
+def delete_employee_attachments(employee_id):
+    """
+    Deletes every File attached to the given Employee with a single DELETE
+    instead of loading and deleting each File document in turn; after the commit,
+    removes the files on disk that no remaining File document points to.
+    Returns the deleted File rows.
+    """
+    filters = {
+        "attached_to_doctype": "Employee",
+        "attached_to_name": employee_id
+    }
+    attachments = frappe.get_all("File", filters=filters, fields=["name", "file_name", "file_url"])
+    if not attachments:
+        return []
+
+    frappe.db.delete("File", filters)
+
+    # Remove the files only once the DELETE is committed, so a rolled back request
+    # keeps them; identical uploads share one file on disk, so keep those still referenced
+    file_urls = {att.file_url for att in attachments if att.file_url}
+    if file_urls:
+        frappe.db.after_commit.add(lambda: remove_unreferenced_files(file_urls))
+
+    return attachments
+
+def remove_unreferenced_files(file_urls):
+    """Removes the given site files from disk unless a File document still points to them"""
+    file_urls = set(file_urls) - set(frappe.get_all("File", filters={
+        "file_url": ("in", list(file_urls))
+    }, pluck="file_url"))
+
+    for file_url in file_urls:
+        relative_path = file_url.lstrip("/")
+        if not relative_path.startswith("private/"):
+            relative_path = f"public/{relative_path}"
+        file_path = frappe.get_site_path(relative_path)
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            frappe.log_error(f"Failed to delete {file_path}: {str(e)}", "File Cleanup Error")
+
+def delete_existing_attachments(employee_id):
+    """
+    Deletes all existing attachments for the given Employee.
+    """
+    try:
+        delete_employee_attachments(employee_id)
         frappe.db.commit()
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "Error Deleting Attachments")
@@ -102,20 +591,163 @@ def delete_existing_attachments(employee_id):
 def get_employee_reference_image(employee_id):
     """
     Fetches the latest reference image attached to the Employee.
-    Returns the File document or None if not found.
+    Returns the File row (name, file_name, file_url) or None if not found.
+    """
+    # Read only the columns callers use instead of loading the File document
+    return frappe.db.get_value("File", {
+        "attached_to_doctype": "Employee",
+        "attached_to_name": employee_id
+    }, ["name", "file_name", "file_url"], order_by="creation desc", as_dict=True)
+
+@lru_cache(maxsize=8)
+def get_site_folder(site, *path):
+    """Resolves (and creates) a folder of the given site once per worker"""
+    folder = frappe.get_site_path(*path)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def get_files_path():
+    """Public files folder of the current site"""
+    return get_site_folder(frappe.local.site, 'public', 'files')
+
+def quantize_encoding(encoding):
+    """
+    Quantizes a face encoding to int8 with a per-vector scale (encoding ~= q * scale).
+    The rounding error stays around 0.01 in face distance, far below the match tolerance.
+    """
+    encoding = np.asarray(encoding, dtype=np.float32)
+    scale = float(np.abs(encoding).max()) / 127 or 1.0
+    return np.round(encoding / scale).astype(np.int8), np.float32(scale)
+
+def parse_client_embedding(embedding_b64):
+    """
+    Validates a client embedding sent as base64 of float32 values (`embedding_b64`),
+    the compact alternative to `embedding_json`. Returns the normalized base64
+    string, or None if the value is not a float32 vector.
     """
     try:
-        # Find the latest File document attached to the Employee
-        file_doc = frappe.get_last_doc("File", filters={
-            "attached_to_doctype": "Employee",
-            "attached_to_name": employee_id
-        })
+        raw = base64.b64decode(embedding_b64, validate=True)
+    except (ValueError, TypeError):
+        return None
+    if not raw or len(raw) % 4:
+        return None
+    embedding = np.frombuffer(raw, dtype=np.float32)
+    if not np.isfinite(embedding).all():
+        return None
+    return base64.b64encode(raw).decode()
+
+def pack_encoding(encoding):
+    """
+    Serializes a face encoding for the Employee `face_encoding` field as base64 of
+    the float32 scale followed by the 128 int8 values (132 bytes instead of 512).
+    """
+    quantized, scale = quantize_encoding(encoding)
+    return base64.b64encode(scale.tobytes() + quantized.tobytes()).decode()
 
-        return file_doc
+def unpack_encoding(stored):
+    """
+    Returns (int8 encoding, scale) from a `face_encoding` value, also accepting
+    the original base64 float32 format.
+    """
+    raw = base64.b64decode(stored)
+    if len(raw) == 128 * 4:
+        return quantize_encoding(np.frombuffer(raw, dtype=np.float32))
+    return np.frombuffer(raw, dtype=np.int8, offset=4), np.frombuffer(raw[:4], dtype=np.float32)[0]
 
-    except frappe.DoesNotExistError:
+def backfill_reference_encodings():
+    """
+    Stores the reference encoding of every registered Employee that predates the
+    `face_encoding` field, so match_face never has to decode their reference image:
+    bench --site <site> execute face_auth.api.face.backfill_reference_encodings
+    """
+    pending = frappe.get_all(
+        "Employee",
+        filters={"face_registered": 1, "face_encoding": ["is", "not set"]},
+        pluck="name"
+    )
+
+    stored = 0
+    for employee_id in pending:
+        ref_file_doc = get_employee_reference_image(employee_id)
+        if not ref_file_doc:
+            continue
+        ref_img = load_reference_image(f"{get_files_path()}/{ref_file_doc.file_name}")
+        if ref_img is None:
+            continue
+        encodings = get_face_encodings(get_detection_image(ref_img))
+        if not encodings:
+            frappe.log_error(f"No face in reference image of {employee_id}", "Face Encoding Backfill")
+            continue
+        save_reference_encoding(employee_id, encodings[0])
+        frappe.db.commit()
+        stored += 1
+    return stored
+
+def save_reference_encoding(employee_id, encoding):
+    """
+    Persists the reference face encoding on the Employee (int8-quantized, see
+    pack_encoding), so that match_face does not have to re-encode the reference image.
+    """
+    frappe.db.set_value(
+        "Employee", employee_id, "face_encoding",
+        pack_encoding(encoding),
+        update_modified=False
+    )
+
+def load_reference_encoding(employee_id):
+    """
+    Returns the reference face encoding (float32) stored on the given Employee, or
+    None if none has been stored yet. Read from the database on every match, so an
+    update or reset on any app server takes effect everywhere at once.
+    """
+    stored = frappe.db.get_value("Employee", employee_id, "face_encoding")
+    if not stored:
         return None
-    
+    quantized, scale = unpack_encoding(stored)
+    # Dequantize into a single float32 allocation
+    return np.multiply(quantized, scale, dtype=np.float32)
+
+def delete_reference_encoding(employee_id):
+    """Removes the stored reference face encoding for the given Employee, if any"""
+    frappe.db.set_value("Employee", employee_id, "face_encoding", None, update_modified=False)
+
+def squared_face_distance(encoding_a, encoding_b):
+    """
+    Squared L2 distance between two face encodings. Uses SimSIMD's runtime
+    dispatched AVX2/AVX-512/NEON kernel when installed, one float32 dot product otherwise.
+    """
+    encoding_a = np.asarray(encoding_a, dtype=np.float32)
+    encoding_b = np.asarray(encoding_b, dtype=np.float32)
+    if simsimd is not None:
+        return float(simsimd.sqeuclidean(encoding_a, encoding_b))
+    diff = encoding_a - encoding_b
+    return float(np.dot(diff, diff))
+
+def strict_face_match(employee_id, ref_image, uploaded_image):
+    """
+    Re-checks a match with the 68-point ("large") landmark model, encoding both the
+    reference and the uploaded image with it so the two encodings are comparable.
+    The reference image is read from the Employee's attachment unless given.
+    Returns False if the reference image cannot be read or either image has no face.
+    """
+    if ref_image is None:
+        ref_file_doc = get_employee_reference_image(employee_id)
+        if not ref_file_doc:
+            return False
+        try:
+            ref_image = get_detection_image(
+                correct_image_orientation(Image.open(f"{get_files_path()}/{ref_file_doc.file_name}"))
+            )
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "Face Matching")
+            return False
+
+    ref_encodings = encode_faces(ref_image, "large")
+    uploaded_encodings = encode_faces(uploaded_image, "large")
+    if not ref_encodings or not uploaded_encodings:
+        return False
+    return squared_face_distance(ref_encodings[0], uploaded_encodings[0]) <= FACE_MATCH_TOLERANCE ** 2
+
 # def get_shift_time_range(employee_id, date_str):
 #     """
 #     Calculate shift time window considering night shifts
@@ -203,44 +835,92 @@ def get_shift_time_range(employee_id, date_str):
     Calculate shift time window considering night shifts
     Returns (start_datetime, end_datetime) as datetime objects
     """
-    # Default fallback (9AM-6PM)
-    default_start = "09:00:00"
-    default_end = "18:00:00"
-    
     # Get employee's shift
     shift_name = frappe.get_value("Employee", employee_id, "shift")
-    if not shift_name:
-        from datetime import datetime, timedelta
-        start_dt = datetime.strptime(f"{date_str} {default_start}", "%Y-%m-%d %H:%M:%S")
-        end_dt = datetime.strptime(f"{date_str} {default_end}", "%Y-%m-%d %H:%M:%S")
-        return (start_dt, end_dt)
-    
-    # Fetch shift details
-    shift = frappe.get_doc("Shift Type", shift_name)
-    
-    # Format time properly
-    from frappe.utils import format_time
+    shift = get_shift_types([shift_name]).get(shift_name) if shift_name else None
+    return get_shift_window(shift, date_str)
+
+def get_shift_types(shift_names):
+    """Start/end times (and night shift flag, if the field exists) of the given Shift Types in one query"""
+    if not shift_names:
+        return {}
+    fields = ["name", "start_time", "end_time"]
+    if frappe.get_meta("Shift Type").has_field("is_night_shift"):
+        fields.append("is_night_shift")
+    shifts = frappe.get_all("Shift Type", filters={"name": ("in", list(shift_names))}, fields=fields)
+    return {shift.name: shift for shift in shifts}
+
+def get_shift_window(shift, date_str):
+    """
+    (start_datetime, end_datetime) of a Shift Type row on the given date,
+    9AM-6PM without a shift; night shifts end on the next day
+    """
+    from frappe.utils import to_timedelta
+
+    # Default fallback (9AM-6PM)
+    default_start = timedelta(hours=9)
+    default_end = timedelta(hours=18)
+
+    # Midnight of the requested day; shift times are offsets from it
+    day_start = datetime.fromisoformat(date_str)
+
+    if not shift:
+        return (day_start + default_start, day_start + default_end)
     
-    start_time = format_time(shift.start_time, "HH:mm:ss") if shift.start_time else "09:00:00"
-    end_time = format_time(shift.end_time, "HH:mm:ss") if shift.end_time else "18:00:00"
+    start_time = to_timedelta(shift.start_time) if shift.start_time else default_start
+    end_time = to_timedelta(shift.end_time) if shift.end_time else default_end
     
-    # Handle night shifts (crossing midnight)
-    if shift.is_night_shift or end_time < start_time:
-        from datetime import datetime, timedelta
-        next_date = (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-        start_dt = datetime.strptime(f"{date_str} {start_time}", "%Y-%m-%d %H:%M:%S")
-        end_dt = datetime.strptime(f"{next_date} {end_time}", "%Y-%m-%d %H:%M:%S")
-        return (start_dt, end_dt)
+    # Handle night shifts (crossing midnight); a window never spans more than a day
+    if shift.get("is_night_shift") or end_time < start_time:
+        start = day_start + start_time
+        return (start, min(day_start + timedelta(days=1) + end_time, start + timedelta(days=1)))
     
-    from datetime import datetime
-    start_dt = datetime.strptime(f"{date_str} {start_time}", "%Y-%m-%d %H:%M:%S")
-    end_dt = datetime.strptime(f"{date_str} {end_time}", "%Y-%m-%d %H:%M:%S")
-    return (start_dt, end_dt)
+    return (day_start + start_time, day_start + end_time)
+
+def get_uploaded_file():
+    """
+    The 'image' upload of the current request, or of the request a background
+    face job is running for (see face_auth.tasks.run_face_job)
+    """
+    return getattr(frappe.local, "face_auth_upload", None) or frappe.request.files.get('image')
+
+def enqueue_face_job(method, file):
+    """
+    Runs a face registration endpoint in a background worker when the site enables
+    `face_auth_background_registration`, so the request only waits for the upload.
+    Returns the "queued" response, or None when the endpoint should run inline.
+    """
+    if not frappe.conf.get("face_auth_background_registration"):
+        return None
+    # Already running inside the background job
+    if getattr(frappe.local, "face_auth_upload", None):
+        return None
+
+    job_key = frappe.generate_hash(length=16)
+    # `method` is frappe.enqueue's own first parameter, so the endpoint goes as `endpoint`
+    frappe.enqueue(
+        "face_auth.tasks.run_face_job",
+        queue="long",
+        endpoint=method,
+        form_dict=dict(frappe.form_dict),
+        content=file.stream.read(),
+        filename=file.filename,
+        job_key=job_key
+    )
+    # Only reported as queued once the job really is
+    frappe.cache().set_value(get_face_job_cache_key(job_key), {"message": "queued"}, expires_in_sec=FACE_JOB_RESULT_TTL)
+    return {"message": "queued", "job_id": job_key}
+
+def get_face_job_cache_key(job_key):
+    return f"face_auth:face_job:{job_key}"
 
 @frappe.whitelist(allow_guest=True)
-def register_face():
-    temp_files = []  # Track all temporary files
+def get_face_job_status(job_id):
+    """Result of a queued register_face/update_face call, {"message": "queued"} until it has run"""
+    return frappe.cache().get_value(get_face_job_cache_key(job_id)) or {"message": "job_not_found"}
 
+@frappe.whitelist(allow_guest=True)
+def register_face():
     # user_id = frappe.form_dict.get('user_id')
     first_name = frappe.form_dict.get('first_name')  # First Name
     middle_name = frappe.form_dict.get('middle_name')  # Middle Name
@@ -256,12 +936,19 @@ def register_face():
     radius_meters = frappe.form_dict.get('radius_meters')  # Radius (Meters)
     
     embedding_json = frappe.form_dict.get('embedding_json')  # embedding_json
+    embedding_b64 = frappe.form_dict.get('embedding_b64')  # base64 float32 embedding
     
     company = frappe.form_dict.get('company')  # designation
     designation = frappe.form_dict.get('designation')  # designation
     department = frappe.form_dict.get('department')  # department
     
     shift = frappe.form_dict.get('shift')  # NEW: Get shift from request
+
+    face_embedding = None
+    if embedding_b64:
+        face_embedding = parse_client_embedding(embedding_b64)
+        if not face_embedding:
+            return {"message": "invalid_embedding"}
     
     # if not user_id:
     #     return {"message": "missing_user_id"}
@@ -274,10 +961,14 @@ def register_face():
     # if frappe.db.get_value("Employee", user_id, "face_registered"):
     #     return {"message": "already_registered"}
 
-    file = frappe.request.files.get('image')
+    file = get_uploaded_file()
     if not file:
         return {"message": "no_image_provided"}
 
+    queued = enqueue_face_job("face_auth.api.face.register_face", file)
+    if queued:
+        return queued
+
     # Split filename and extension
     filename_without_ext, ext = os.path.splitext(file.filename)
 
@@ -285,32 +976,23 @@ def register_face():
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     new_filename = f"{filename_without_ext}_{timestamp}{ext}"  # Only one .jpg at end
 
-    site_path = frappe.get_site_path('public', 'files')
-    os.makedirs(site_path, exist_ok=True)
-
-    save_path = os.path.join(site_path, new_filename)
-
-    # Read file content once for reuse
-    file_content = file.read()
-
-    # Save the uploaded file to disk
-    with open(save_path, 'wb') as f:
-        f.write(file_content)
-    temp_files.append(save_path)  # Track this temporary file
-    if not correct_image_orientation(save_path):
+    # Decode and correct the upload in memory - no temporary file on disk
+    img = load_uploaded_image(file)
+    if img is None:
         return {"message": "image_processing_failed"}
-    with open(save_path, 'rb') as f:
-        corrected_file_content = f.read()
 
     try:
-        image = face_recognition.load_image_file(save_path)
-        encodings = face_recognition.face_encodings(image, num_jitters=1, model="large")
+        image = get_detection_image(img)
+        encodings = get_face_encodings(image)
         if not encodings:
             return {"message": "no_face_detected"}
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "Face Encoding Error")
         return {"message": "face_encoding_failed"}
 
+    # Only encode the JPEG to store once the upload is known to contain a face
+    corrected_file_content = encode_jpeg(img)
+
     # Save attachment (ignore permissions for guest)
     try:
         # ✅ Register Employee document
@@ -327,6 +1009,7 @@ def register_face():
                     "office_longitude": office_longitude,
                     "radius_meters": radius_meters,
                     "embedding_json": embedding_json,
+                    "face_embedding": face_embedding,
                     "company": company,
                     "designation": designation,
                     "department": department,
@@ -335,7 +1018,6 @@ def register_face():
                 })
       
         employee.save(ignore_permissions=True)
-        frappe.db.commit()
         
         file_doc = frappe.get_doc({
             "doctype": "File",
@@ -348,26 +1030,22 @@ def register_face():
             "content": corrected_file_content 
         })
         file_doc.save(ignore_permissions=True)
+
+        # Cache the reference encoding so match_face can skip re-encoding
+        save_reference_encoding(employee.name, encodings[0])
+
+        # One commit for the Employee, its encoding and the image
         frappe.db.commit()
 
         return {"message": "success"}
     except Exception as e:
+        # Nothing of a failed registration is kept
+        frappe.db.rollback()
         frappe.log_error(frappe.get_traceback(), "Attachment Save Failed")
         return {"message": "attachment_save_failed"}
-    finally:
-        # 🧹 Clean up ALL temporary files
-        for file_path in temp_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    frappe.log(f"Deleted temporary file: {file_path}")
-            except Exception as e:
-                frappe.log_error(f"Failed to delete {file_path}: {str(e)}", "File Cleanup Error")
     
 @frappe.whitelist(allow_guest=True)
 def update_face():
-    temp_files = []  # Track all temporary files for cleanup
-
     employee_id = frappe.form_dict.get('employee_id')
     first_name = frappe.form_dict.get('first_name')  # First Name
     middle_name = frappe.form_dict.get('middle_name')  # Middle Name
@@ -383,6 +1061,7 @@ def update_face():
     radius_meters = frappe.form_dict.get('radius_meters')  # Radius (Meters)
     
     embedding_json = frappe.form_dict.get('embedding_json')  # embedding_json
+    embedding_b64 = frappe.form_dict.get('embedding_b64')  # base64 float32 embedding
     
     company = frappe.form_dict.get('company')  # designation
     designation = frappe.form_dict.get('designation')  # designation
@@ -390,6 +1069,12 @@ def update_face():
     
     shift = frappe.form_dict.get('shift')
 
+    face_embedding = None
+    if embedding_b64:
+        face_embedding = parse_client_embedding(embedding_b64)
+        if not face_embedding:
+            return {"message": "invalid_embedding"}
+
     # if not user_id:
     #     return {"message": "missing_user_id"}
 
@@ -401,109 +1086,105 @@ def update_face():
     if not ref_file_doc:
         return {"message": {"matched": False, "reason": "reference_image_missing"}}
 
-    upload_path_last = os.path.join(frappe.get_site_path('public', 'files'), ref_file_doc.file_name)
-    temp_files.append(upload_path_last)
-
     # Handle uploaded image
-    file = frappe.request.files.get('image')
+    file = get_uploaded_file()
     if not file:
         return {"message": "no_image_provided"}
 
+    queued = enqueue_face_job("face_auth.api.face.update_face", file)
+    if queued:
+        return queued
+
     filename_without_ext, ext = os.path.splitext(file.filename)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     new_filename = f"{filename_without_ext}_{timestamp}{ext}"
 
-    site_path = frappe.get_site_path('public', 'files')
-    os.makedirs(site_path, exist_ok=True)
-    save_path = os.path.join(site_path, new_filename)
-
-    file_content = file.read()
-    with open(save_path, 'wb') as f:
-        f.write(file_content)
-    temp_files.append(save_path)
-
-    # Optional: Correct image orientation
-    if not correct_image_orientation(save_path):
+    # Decode and correct the upload in memory - no temporary file on disk
+    img = load_uploaded_image(file)
+    if img is None:
         return {"message": "image_processing_failed"}
 
-    with open(save_path, 'rb') as f:
-        corrected_file_content = f.read()
-
     # Face encoding
     try:
-        image = face_recognition.load_image_file(save_path)
-        encodings = face_recognition.face_encodings(image, num_jitters=1, model="large")
+        image = get_detection_image(img)
+        encodings = get_face_encodings(image)
         if not encodings:
             return {"message": "no_face_detected"}
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "Face Encoding Error")
         return {"message": "face_encoding_failed"}
 
+    # Only encode the JPEG to store once the upload is known to contain a face
+    corrected_file_content = encode_jpeg(img)
+
     # Remove old attachments
     try:
-        attachments = frappe.get_all("File", {
-            "attached_to_doctype": "Employee",
-            "attached_to_name": employee_id
-        })
-        for attach in attachments:
-            doc = frappe.get_doc("File", attach.name)
-            doc.delete(ignore_permissions=True)
+        delete_employee_attachments(employee_id)
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(frappe.get_traceback(), "Cleanup Failed")
         return {"message": "cleanup_failed"}
 
     # Save new face image
     try:
-        # ✅ Update Employee document
-        employee = frappe.get_doc({
-                    "doctype": "Employee",
-                    "first_name": first_name,
-                    "middle_name": middle_name,
-                    "last_name": last_name,
-                    "gender": gender,
-                    "date_of_birth": date_of_birth,
-                    "status": status,
-                    "date_of_joining": date_of_joining,
-                    "office_latitude": office_latitude,
-                    "office_longitude": office_longitude,
-                    "radius_meters": radius_meters,
-                    "embedding_json": embedding_json,
-                    "company": company,
-                    "designation": designation,
-                    "department": department,
-                    "shift": shift,
-                    "face_registered": 1,  # Mark as registered
-                })
-      
-        employee.save(ignore_permissions=True)
-        frappe.db.commit()
+        # ✅ Update Employee document - one UPDATE for the submitted fields
+        # instead of loading and re-validating the whole document
+        values = {
+            "first_name": first_name,
+            "middle_name": middle_name,
+            "last_name": last_name,
+            "gender": gender,
+            "date_of_birth": date_of_birth,
+            "status": status,
+            "date_of_joining": date_of_joining,
+            "office_latitude": office_latitude,
+            "office_longitude": office_longitude,
+            "radius_meters": radius_meters,
+            "embedding_json": embedding_json,
+            "face_embedding": face_embedding,
+            "company": company,
+            "designation": designation,
+            "department": department,
+            "shift": shift,
+        }
+        # Only columns the Employee actually has; custom fields may be missing on a site
+        meta = frappe.get_meta("Employee")
+        values = {
+            field: value for field, value in values.items()
+            if value is not None and meta.has_field(field)
+        }
+        if first_name:
+            values["employee_name"] = " ".join(filter(None, [first_name, middle_name, last_name]))
+        values["face_registered"] = 1  # Mark as registered
+
+        frappe.db.set_value("Employee", employee_id, values)
         
         file_doc = frappe.get_doc({
             "doctype": "File",
             "file_name": new_filename,
             "attached_to_doctype": "Employee",
-            "attached_to_name": employee.name,
+            "attached_to_name": employee_id,
             "folder": "Home",
             "is_private": 0,
             "content": corrected_file_content
         })
         file_doc.save(ignore_permissions=True)
 
+        # Refresh the cached reference encoding
+        save_reference_encoding(employee_id, encodings[0])
+
+        # One commit for the old images' removal, the Employee, its encoding and the new image
+        frappe.db.commit()
+        # set_value skips on_update, so drop the cached office coordinates here
+        clear_office_coordinates_cache(frappe._dict(name=employee_id))
+
         return {"message": "updated"}
 
     except Exception as e:
+        # Keep the previous image and encoding if the update fails
+        frappe.db.rollback()
         frappe.log_error(frappe.get_traceback(), "Update Save Failed")
         return {"message": "update_failed"}
-
-    finally:
-        # Clean up temporary files
-        for file_path in temp_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    frappe.log(f"Deleted temporary file: {file_path}")
-            except Exception as e:
-                frappe.log_error(f"Failed to delete {file_path}: {str(e)}", "File Cleanup Error")
     
 @frappe.whitelist(allow_guest=True)
 def reset_face_registration(employee_id):
@@ -517,34 +1198,28 @@ def reset_face_registration(employee_id):
     # Set the registration flag to 0 (unregistered)
     frappe.db.set_value("Employee", employee_id, "face_registered", 0)
 
-    # Find all 'File' documents attached to this employee
-    attachments = frappe.get_all("File", filters={
-        "attached_to_doctype": "Employee",
-        "attached_to_name": employee_id
-    }, fields=["name", "file_name"])
+    # Drop the cached reference encoding along with the reference image
+    delete_reference_encoding(employee_id)
+
+    # Delete all 'File' documents attached to this employee in one statement
+    try:
+        attachments = delete_employee_attachments(employee_id)
+    except Exception as e:
+        # Keep the registration as it was rather than committing half a reset
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Face Registration Reset Error")
+        return {"status": "error", "message": "attachment_delete_failed"}
+
+    frappe.db.commit()
 
     if not attachments:
-        frappe.db.commit()
         return {"status": "success", "message": "reset_but_no_attachments_found"}
 
-    # Loop through and delete them using the Frappe API
-    # This also handles deleting the physical file from the disk.
-    for att in attachments:
-        try:
-            frappe.delete_doc("File", att.name, ignore_permissions=True, force=True)
-            frappe.log_info(f"Deleted attachment {att.file_name} for employee {user_id}", "Face Registration Reset")
-        except Exception as e:
-            frappe.log_error(f"Failed to delete file doc {att.name}: {e}", "Face Registration Reset Error")
-    
-    frappe.db.commit()
-    
     return {"status": "success", "message": "face_registration_reset_successfully"}
 
 
 @frappe.whitelist(allow_guest=True)
 def match_face():
-    temp_files = []  # Track all temporary files
-
     employee_id = frappe.form_dict.get('employee_id')
     latitude = frappe.form_dict.get('latitude')
     longitude = frappe.form_dict.get('longitude')
@@ -552,85 +1227,96 @@ def match_face():
     if not employee_id:
         return {"message": {"matched": False, "reason": "missing_user_id"}}
 
+    # Reject malformed locations before any image work; without a location the face is
+    # only verified and no check-in is created
+    if bool(latitude) != bool(longitude):
+        return {"message": {"matched": False, "reason": "missing_location"}}
+    # Decided on the submitted strings: 0.0 is a valid coordinate once converted
+    has_location = bool(latitude and longitude)
+    if has_location:
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except ValueError:
+            return {"message": {"matched": False, "reason": "invalid_location"}}
+
     try:
         file = frappe.request.files['image']
-        upload_path = os.path.join(frappe.get_site_path('public', 'files'), file.filename)
-
-        # Read file content once and save it to disk
-        file_content = file.read()
-        with open(upload_path, 'wb') as f:
-            f.write(file_content)
-        temp_files.append(upload_path)  # Track this temporary file
-        # Correct EXIF orientation and resize
-        if not correct_image_orientation(upload_path):
-            return {"message": {"matched": False, "reason": "image_processing_failed"}}
-
-        # Process uploaded image
-        uploaded_image = face_recognition.load_image_file(upload_path)
-        uploaded_encodings = face_recognition.face_encodings(
-            uploaded_image, 
-            num_jitters=1,
-            model="large"
-        )
-
-        if not uploaded_encodings:
-            return {"message": {"matched": False, "reason": "no_face_in_uploaded_image"}}
-
-        uploaded_encoding = uploaded_encodings[0]
 
+        ref_encoding = load_reference_encoding(employee_id)
+        ref_image = None
+        if ref_encoding is None:
+            # No cached encoding yet (registered before caching) - encode the reference image once
+            ref_file_doc = get_employee_reference_image(employee_id)
+            if not ref_file_doc:
+                return {"message": {"matched": False, "reason": "reference_image_missing"}}
+            ref_image_path = f"{get_files_path()}/{ref_file_doc.file_name}"
+
+            if not os.path.exists(ref_image_path):
+                frappe.log_error(f"Reference image file does not exist at path: {ref_image_path}", "Face Matching")
+                return {"message": {"matched": False, "reason": "reference_image_file_not_found"}}
+
+            # In memory only; for an already corrected reference the orientation and
+            # resize steps are no-ops and nothing is rewritten
+            try:
+                ref_image = get_detection_image(correct_image_orientation(Image.open(ref_image_path)))
+            except Exception as e:
+                frappe.log_error(f"EXIF correction failed: {str(e)}", "Image Correction Error")
+                return {"message": {"matched": False, "reason": "reference_image_corruption"}}
 
-        ref_file_doc = get_employee_reference_image(employee_id)
-        if not ref_file_doc:
-            return {"message": {"matched": False, "reason": "reference_image_missing"}}
-        ref_image_path = os.path.join(frappe.get_site_path('public', 'files'), ref_file_doc.file_name)
-
-        # ✅ FIX: Properly validate ref_image_path before using os.path.exists()
-        if not ref_image_path:
-            frappe.log_error(f"Reference image path is None for {employee_id}", "Face Matching")
-            return {"message": {"matched": False, "reason": "reference_image_missing"}}
-        
-        if not os.path.exists(ref_image_path):
-            frappe.log_error(f"Reference image file does not exist at path: {ref_image_path}", "Face Matching")
-            return {"message": {"matched": False, "reason": "reference_image_file_not_found"}}
-
-        # Correct reference image if needed
-        if not correct_image_orientation(ref_image_path):
-            return {"message": {"matched": False, "reason": "reference_image_corruption"}}
-
-        ref_image = face_recognition.load_image_file(ref_image_path)
-        ref_encodings = face_recognition.face_encodings(
-            ref_image,
-            num_jitters=1,
-            model="large"
-        )
-        
-        if not ref_encodings:
-            return {"message": {"matched": False, "reason": "reference_image_has_no_face"}}
+        # Decode, correct EXIF orientation and resize in memory
+        img = load_uploaded_image(file)
+        if img is None:
+            return {"message": {"matched": False, "reason": "image_processing_failed"}}
 
-        ref_encoding = ref_encodings[0]
+        # Process uploaded image
+        uploaded_image = get_detection_image(img)
+
+        if ref_image is None:
+            uploaded_encodings = get_face_encodings(uploaded_image)
+            if not uploaded_encodings:
+                return {"message": {"matched": False, "reason": "no_face_in_uploaded_image"}}
+        else:
+            # Encode the uploaded and the reference image together (one batch when batching is on)
+            uploaded_encodings, ref_encodings = get_face_encodings_for([uploaded_image, ref_image])
+            if not uploaded_encodings:
+                return {"message": {"matched": False, "reason": "no_face_in_uploaded_image"}}
+            if not ref_encodings:
+                return {"message": {"matched": False, "reason": "reference_image_has_no_face"}}
+
+            ref_encoding = np.asarray(ref_encodings[0], dtype=np.float32)
+            save_reference_encoding(employee_id, ref_encoding)
+
+        # face_recognition returns float64; convert once for the float32 distance kernels
+        uploaded_encoding = np.asarray(uploaded_encodings[0], dtype=np.float32)
 
         # Calculate match confidence
-        distance = face_recognition.face_distance([ref_encoding], uploaded_encoding)[0]
-        confidence = max(0, min(100, (1.0 - distance) * 100))
-        match_result = distance <= 0.5
+        # Squared L2 distance, compared against the squared tolerance
+        distance_sq = squared_face_distance(ref_encoding, uploaded_encoding)
+        match_result = distance_sq <= FACE_MATCH_TOLERANCE ** 2
+        if (
+            match_result
+            and math.sqrt(distance_sq) >= FACE_MATCH_TOLERANCE - FACE_MATCH_STRICT_MARGIN
+            and (frappe.conf.get("face_encoding_model") or FACE_LANDMARK_MODEL) != "large"
+        ):
+            # Borderline accept: it must also pass with the more precise 68-point alignment.
+            # Rejections are never re-checked, so this can only turn a match into a failure
+            match_result = strict_face_match(employee_id, ref_image, uploaded_image)
+        distance = math.sqrt(distance_sq)
+        confidence = round(max(0, min(100, (1.0 - distance) * 100)), 1)
+
+        # Fields shared by every response below, computed once
+        result = {
+            "matched": match_result,
+            "distance": round(distance, 4),
+            "confidence": confidence,
+        }
         if not match_result:
             # If face match fails, return early with confidence
-            return {
-                "message": {
-                    "matched": False,
-                    "distance": round(float(distance), 4),
-                    "confidence": round(confidence, 1),
-                    "reason": "face_not_matching"
-                }
-            }
+            return {"message": {**result, "reason": "face_not_matching"}}
 
         # If face match is successful, validate geofencing before saving
-        if match_result and latitude and longitude:
+        if has_location:
             try:
-                # Convert to floats
-                latitude = float(latitude)
-                longitude = float(longitude)
-                
                 # Get office coordinates from Employee document
                 office_lat, office_long, geofence_radius = get_office_coordinates(employee_id)
                 
@@ -638,59 +1324,69 @@ def match_face():
                 if not office_lat or not office_long:
                     return {
                         "message": {
-                            "matched": True,
-                            "distance": round(float(distance), 4),
-                            "confidence": round(confidence, 1),
+                            **result,
                             "checkin_saved": False,
                             "error": "office_coordinates_not_set"
                         }
                     }
                 
-                # Calculate distance from office
-                distance_from_office = calculate_distance(
-                    latitude, longitude, 
+                # Calculate distance from office; the cheap approximation settles
+                # check-ins well outside the geofence without the exact Haversine
+                distance_from_office = approximate_distance(
+                    latitude, longitude,
                     office_lat, office_long
                 )
+                # Only a point near the boundary needs the exact Haversine distance
+                if geofence_radius / GEOFENCE_PREFILTER_MARGIN < distance_from_office <= geofence_radius * GEOFENCE_PREFILTER_MARGIN:
+                    distance_from_office = calculate_distance(
+                        latitude, longitude,
+                        office_lat, office_long
+                    )
+                distance_from_office = round(distance_from_office, 3)
                 
                 # Check if within geofence radius
                 if distance_from_office > geofence_radius:
                     return {
                         "message": {
-                            "matched": True,
-                            "distance": round(float(distance), 4),
-                            "confidence": round(confidence, 1),
+                            **result,
                             "checkin_saved": False,
-                            "error": f"outside_geofence_radius",
-                            "distance_from_office": round(distance_from_office, 3),
+                            "error": "outside_geofence_radius",
+                            "distance_from_office": distance_from_office,
                             "geofence_radius": geofence_radius
                         }
                     }
                 
+                checkin = dict(
+                    employee_id=employee_id,
+                    device_id=device_id,
+                    latitude=latitude,
+                    longitude=longitude,
+                    time=frappe.utils.now_datetime(),
+                    distance_from_office=distance_from_office,
+                    confidence=confidence
+                )
+                if frappe.conf.get("face_auth_background_checkin"):
+                    # Create checkin record (only if within geofence) in the background
+                    frappe.enqueue("face_auth.tasks.create_checkin", queue="short", **checkin)
+                    return {
+                        "message": {
+                            **result,
+                            "checkin_queued": True,
+                            "distance_from_office": distance_from_office,
+                            "geofence_radius": geofence_radius
+                        }
+                    }
+
                 # Create checkin record (only if within geofence)
-                checkin_doc = frappe.get_doc({
-                    "doctype": "Employee Checkin",
-                    "employee": employee_id,
-                    "time": frappe.utils.now_datetime(),
-                    "device_id": device_id,
-                    "latitude": latitude,
-                    "longitude": longitude,
-                    "location": f"{latitude}, {longitude}",
-                    "skip_auto_attendance": 0,
-                    "attendance": None,
-                    "distance_from_office": round(distance_from_office, 3),
-                    "confidence": round(confidence, 1)
-                })
-                checkin_doc.insert(ignore_permissions=True)
+                checkin_name = insert_checkin(**checkin)
                 frappe.db.commit()
 
                 return {
                     "message": {
-                        "matched": True,
-                        "distance": round(float(distance), 4),
-                        "confidence": round(confidence, 1),
+                        **result,
                         "checkin_saved": True,
-                        "checkin_name": checkin_doc.name,
-                        "distance_from_office": round(distance_from_office, 3),
+                        "checkin_name": checkin_name,
+                        "distance_from_office": distance_from_office,
                         "geofence_radius": geofence_radius,
                         # "reference_image": ref_file_docname  # Return reference image doc name
                     }
@@ -700,37 +1396,68 @@ def match_face():
                 frappe.log_error(frappe.get_traceback(), "Checkin Creation Error")
                 return {
                     "message": {
-                        "matched": True,
-                        "distance": round(float(distance), 4),
-                        "confidence": round(confidence, 1),
+                        **result,
                         "checkin_saved": False,
                         "error": f"Checkin failed: {str(checkin_error)}"
                     }
                 }
         
         # Return confidence even when match fails (for debugging)
-        return {
-            "message": {
-                "matched": match_result,
-                "distance": round(float(distance), 4),
-                "confidence": round(confidence, 1),
-                "reason": "face_not_matching" if not match_result else None
-            }
-        }
+        return {"message": {**result, "reason": None}}
     
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "Face Match Error")
         return {"message": {"matched": False, "error": str(e)}}
-    finally:
-        # 🧹 Clean up ALL temporary files
-        for file_path in temp_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    frappe.log(f"Deleted temporary file: {file_path}")
-            except Exception as e:
-                frappe.log_error(f"Failed to delete {file_path}: {str(e)}", "File Cleanup Error")
-                
+
+def insert_checkin(employee_id, device_id, latitude, longitude, time, distance_from_office, confidence):
+    """Inserts the Employee Checkin for a successful face match. Returns its name."""
+    checkin_doc = frappe.get_doc({
+        "doctype": "Employee Checkin",
+        "employee": employee_id,
+        "time": time,
+        "device_id": device_id,
+        "latitude": latitude,
+        "longitude": longitude,
+        "location": f"{latitude}, {longitude}",
+        "skip_auto_attendance": 0,
+        "attendance": None,
+        "distance_from_office": distance_from_office,
+        "confidence": confidence
+    })
+    checkin_doc.insert(ignore_permissions=True)
+    return checkin_doc.name
+
+def insert_location(employee_id, latitude, longitude, timestamp):
+    """
+    Appends a tracking point to tabLocation with a single INSERT, skipping the
+    Location controller (naming, link validation, nested set updates), which costs far
+    more than the row itself. The ping timestamp doubles as creation/modified.
+    Returns the Location name.
+    """
+    name = f"Track-{employee_id}-{timestamp}"
+    user = frappe.session.user
+    frappe.db.sql("""
+        INSERT INTO `tabLocation`
+            (name, location_name, employee, latitude, longitude, custom_timestamp,
+            creation, modified, owner, modified_by)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, (name, name, employee_id, latitude, longitude, timestamp, timestamp, timestamp, user, user))
+    return name
+
+def is_repeated_location(employee_id, latitude, longitude, timestamp):
+    """
+    True when the employee reported (nearly) the same point within LOCATION_DEDUP_WINDOW,
+    as stationary devices do every few seconds. Otherwise records this point as the last one.
+    """
+    last = frappe.cache().hget("face_auth:last_location", employee_id)
+    if last:
+        last_latitude, last_longitude, last_timestamp = last
+        delta = (latitude - last_latitude) ** 2 + (longitude - last_longitude) ** 2
+        if delta < LOCATION_DEDUP_THRESHOLD and (timestamp - last_timestamp).total_seconds() < LOCATION_DEDUP_WINDOW:
+            return True
+    frappe.cache().hset("face_auth:last_location", employee_id, (latitude, longitude, timestamp))
+    return False
+
 @frappe.whitelist(allow_guest=True)
 def track_location():
     # frappe.log("Tracking location for employee")
@@ -758,20 +1485,28 @@ def track_location():
         frappe.throw(_("Latitude and Longitude are required"))
 
     try:
+        latitude, longitude = float(latitude), float(longitude)
+        timestamp = frappe.utils.now_datetime()
+        if is_repeated_location(employee_id, latitude, longitude, timestamp):
+            return {"message": "deduped"}
+
+        if frappe.conf.get("face_auth_background_location_tracking"):
+            # Insert and commit in a worker so the ping does not wait on the fsync
+            frappe.enqueue(
+                "face_auth.tasks.create_location",
+                queue="short",
+                employee_id=employee_id,
+                latitude=latitude,
+                longitude=longitude,
+                timestamp=timestamp
+            )
+            return {
+                "message": "location_queued",
+                "timestamp": timestamp
+            }
+
         # Create Location log
-        location = frappe.get_doc({
-            "doctype": "Location",
-            "location_name": f"Track-{employee_id}-{frappe.utils.now()}",  # auto-naming
-            "latitude": float(latitude),
-            "longitude": float(longitude),
-            "employee": employee_id,
-            # "user": user,
-            "custom_timestamp": frappe.utils.now_datetime(),
-            # "battery_level": battery_level,
-            # "accuracy": accuracy,
-            # "location_type": location_type
-        })
-        location.insert(ignore_permissions=True)  # Bypass permission checks
+        location_name = insert_location(employee_id, latitude, longitude, timestamp)
 
         # Optional: Update Employee last known location
         # employee = frappe.get_doc("Employee", employee_id)
@@ -784,14 +1519,72 @@ def track_location():
 
         return {
             "message": "location_tracked",
-            "location": location.name,
-            "timestamp": location.custom_timestamp
+            "location": location_name,
+            "timestamp": timestamp
         }
 
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "Location Tracking Failed")
         frappe.throw(_("Failed to track location"))
 
+@frappe.whitelist(allow_guest=True)
+def track_locations_bulk(employee_id, points):
+    """
+    Track a batch of buffered GPS points for an employee in one insert and one commit.
+    Args:
+        employee_id (str): Employee ID
+        points (list | str): JSON list of {"latitude", "longitude", "timestamp" (optional)}
+    """
+    if not frappe.db.exists("Employee", employee_id):
+        frappe.throw(_("Invalid Employee ID"))
+
+    points = frappe.parse_json(points) or []
+    if not isinstance(points, list):
+        frappe.throw(_("Points must be a list"))
+    if len(points) > LOCATION_BULK_MAX_POINTS:
+        frappe.throw(_("At most {0} points can be sent at once").format(LOCATION_BULK_MAX_POINTS))
+
+    now = frappe.utils.now_datetime()
+    user = frappe.session.user
+    values = []
+    for i, point in enumerate(points):
+        if not isinstance(point, dict):
+            frappe.throw(_("Point {0} must be an object").format(i))
+        if point.get("latitude") in (None, "") or point.get("longitude") in (None, ""):
+            frappe.throw(_("Latitude and Longitude are required"))
+        try:
+            latitude, longitude = float(point["latitude"]), float(point["longitude"])
+            timestamp = frappe.utils.get_datetime(point.get("timestamp") or now)
+        except (TypeError, ValueError):
+            frappe.throw(_("Point {0} has an invalid latitude, longitude or timestamp").format(i))
+        # Location names are unique, so suffix the position within the batch
+        name = f"Track-{employee_id}-{now}-{i}"
+        values.append((
+            name, name, employee_id,
+            latitude, longitude, timestamp,
+            now, now, user, user
+        ))
+
+    if not values:
+        return {"message": "location_tracked", "count": 0}
+
+    try:
+        # Plain multi-row INSERT: the Location controller and its nested set
+        # bookkeeping are skipped, these rows are leaf telemetry only
+        frappe.db.bulk_insert(
+            "Location",
+            ["name", "location_name", "employee", "latitude", "longitude", "custom_timestamp",
+             "creation", "modified", "owner", "modified_by"],
+            values
+        )
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Location Tracking Failed")
+        frappe.throw(_("Failed to track location"))
+
+    return {"message": "location_tracked", "count": len(values)}
+
 # @frappe.whitelist(allow_guest=True)
 # def get_latest_locations():
 #     # Get latest location for all employees
@@ -821,15 +1614,24 @@ def get_latest_locations(employee_id=None):
             LIMIT 1
         """, employee_id, as_dict=True)
     else:
-        # Get latest location for all employees (current behavior)
-        return frappe.db.sql("""
+        cached = frappe.cache().get_value("face_auth:latest_locations")
+        if cached is not None:
+            return cached
+
+        # Get latest location for all employees (current behavior) in one pass
+        # over the (employee, custom_timestamp) index instead of a correlated subquery
+        locations = frappe.db.sql("""
             SELECT employee, latitude, longitude, custom_timestamp
-            FROM `tabLocation`
-            WHERE custom_timestamp = (
-                SELECT MAX(custom_timestamp) FROM `tabLocation` AS sub
-                WHERE sub.employee = `tabLocation`.employee
-            )
+            FROM (
+                SELECT employee, latitude, longitude, custom_timestamp,
+                    RANK() OVER (PARTITION BY employee ORDER BY custom_timestamp DESC) AS position
+                FROM `tabLocation`
+                WHERE employee IS NOT NULL AND custom_timestamp IS NOT NULL
+            ) AS ranked
+            WHERE position = 1
         """, as_dict=True)
+        frappe.cache().set_value("face_auth:latest_locations", locations, expires_in_sec=LATEST_LOCATIONS_CACHE_TTL)
+        return locations
 
 # @frappe.whitelist(allow_guest=True)
 # def get_historical_path(employee, date):
@@ -842,22 +1644,89 @@ def get_latest_locations(employee_id=None):
 #         fields=["latitude", "longitude", "custom_timestamp"],
 #         order_by="custom_timestamp asc"
 #     )
+def downsample_path(locations, step=None):
+    """
+    Keeps every `step`-th point of a time-ordered path plus its last point. The step is
+    raised as needed to stay within HISTORICAL_PATH_MAX_POINTS.
+    """
+    step = max(cint(step), -(-len(locations) // HISTORICAL_PATH_MAX_POINTS), 1)
+    if step == 1:
+        return locations
+    sampled = locations[::step]
+    if (len(locations) - 1) % step:
+        sampled.append(locations[-1])
+    return sampled
+
+def downsample_paths(locations, step=None):
+    """downsample_path for rows of several employees, ordered by employee then time"""
+    paths = []
+    for _employee, path in groupby(locations, key=lambda location: location.employee):
+        paths.extend(downsample_path(list(path), step))
+    return paths
+
+def get_employee_path(employee, start, end):
+    """
+    Time-ordered locations of one employee between start and end, thinned evenly to at
+    most about HISTORICAL_PATH_MAX_ROWS points. Plain SQL over the
+    (employee, custom_timestamp) index; get_all's query builder and permission
+    conditions only add overhead on paths of thousands of rows.
+    """
+    return frappe.db.sql("""
+        SELECT latitude, longitude, custom_timestamp
+        FROM (
+            SELECT latitude, longitude, custom_timestamp,
+                ROW_NUMBER() OVER (ORDER BY custom_timestamp) AS position,
+                COUNT(*) OVER () AS points
+            FROM `tabLocation`
+            WHERE employee = %s AND custom_timestamp BETWEEN %s AND %s
+        ) AS numbered
+        WHERE MOD(position - 1, CEIL(points / %s)) = 0 OR position = points
+        ORDER BY custom_timestamp ASC
+    """, (employee, start, end, HISTORICAL_PATH_MAX_ROWS), as_dict=True)
+
+def validate_path_date(date):
+    """The requested day as YYYY-MM-DD, throwing for anything that is not a date"""
+    try:
+        parsed = frappe.utils.getdate(date) if date else None
+    except Exception:
+        parsed = None
+    if not parsed:
+        frappe.throw(_("Invalid date"))
+    return str(parsed)
+
+def path_columns(locations):
+    """
+    A path as parallel arrays, {"lat": [...], "lon": [...], "ts": [...]}, with ts in
+    UNIX seconds. Much smaller to encode and send than one dict per point.
+    """
+    timezone = ZoneInfo(get_system_timezone())
+    return {
+        "lat": [location.latitude for location in locations],
+        "lon": [location.longitude for location in locations],
+        "ts": [int(location.custom_timestamp.replace(tzinfo=timezone).timestamp()) for location in locations]
+    }
+
+def paths_columns(locations):
+    """path_columns per employee for rows ordered by employee then time"""
+    return {
+        employee: path_columns(list(path))
+        for employee, path in groupby(locations, key=lambda location: location.employee)
+    }
+
 @frappe.whitelist(allow_guest=True)
-def get_historical_path(employee, date):
-    """Single employee path using shift times"""
+def get_historical_path(employee, date, step=None, columnar=None):
+    """
+    Single employee path using shift times, optionally keeping every `step`-th point.
+    With `columnar`, returned as parallel lat/lon/ts arrays.
+    """
+    date = validate_path_date(date)
     start, end = get_shift_time_range(employee, date)
     frappe.log(f"Fetching historical path for {employee} from {start} to {end}")
-    return frappe.get_all("Location",
-        filters=[
-            ["employee", "=", employee],
-            ["custom_timestamp", "between", [start, end]]
-        ],
-        fields=["latitude", "longitude", "custom_timestamp"],
-        order_by="custom_timestamp asc"
-    )
+    locations = downsample_path(get_employee_path(employee, start, end), step)
+    return path_columns(locations) if cint(columnar) else locations
 
 @frappe.whitelist(allow_guest=True)
-def get_filtered_historical_paths(date, department=None, branch=None, employee_id=None):
+def get_filtered_historical_paths(date, department=None, branch=None, employee_id=None, step=None, columnar=None):
     """
     Get historical paths with flexible filtering options:
     - For a single employee (when employee_id is provided)
@@ -868,7 +1737,11 @@ def get_filtered_historical_paths(date, department=None, branch=None, employee_i
         department (str, optional): Department filter
         branch (str, optional): branch filter
         employee_id (str, optional): Specific employee to query
+        step (int, optional): Keep every step-th point of each path
+        columnar (bool, optional): Return lat/lon/ts arrays (keyed by employee for groups)
     """
+    date = validate_path_date(date)
+
     # Handle single employee case
     if employee_id:
         # Verify employee exists
@@ -879,14 +1752,8 @@ def get_filtered_historical_paths(date, department=None, branch=None, employee_i
         start, end = get_shift_time_range(employee_id, date)
         
         # Fetch locations for single employee
-        return frappe.get_all("Location",
-            filters=[
-                ["employee", "=", employee_id],
-                ["custom_timestamp", "between", [start, end]]
-            ],
-            fields=["latitude", "longitude", "custom_timestamp"],
-            order_by="custom_timestamp asc"
-        )
+        locations = downsample_path(get_employee_path(employee_id, start, end), step)
+        return path_columns(locations) if cint(columnar) else locations
     
     # Handle filtered employee group case (existing functionality)
     employee_filters = {}
@@ -901,38 +1768,43 @@ def get_filtered_historical_paths(date, department=None, branch=None, employee_i
     )
     
     if not employees:
-        return []
+        return {} if cint(columnar) else []
     
-    # Calculate time ranges for all employees
+    # Calculate time ranges for all employees, with all their shifts fetched in one query
+    shifts = get_shift_types({emp.shift for emp in employees if emp.shift})
     time_ranges = {}
     for emp in employees:
-        start, end = get_shift_time_range(emp.name, date)
+        start, end = get_shift_window(shifts.get(emp.shift), date)
         time_ranges[emp.name] = (start, end)
     
-    # Determine overall time window
-    all_starts = [r[0] for r in time_ranges.values()]
-    all_ends = [r[1] for r in time_ranges.values()]
-    overall_start = min(all_starts)
-    overall_end = max(all_ends)
-    
-    # Fetch locations in one efficient query
-    locations = frappe.get_all("Location",
-        filters=[
-            ["employee", "in", [e.name for e in employees]],
-            ["custom_timestamp", "between", [overall_start, overall_end]]
-        ],
-        fields=["employee", "latitude", "longitude", "custom_timestamp"],
-        order_by="employee, custom_timestamp asc"
-    )
-    
-    # Filter locations per employee's shift window
-    result = []
-    for loc in locations:
-        emp_start, emp_end = time_ranges.get(loc.employee, (None, None))
-        if emp_start and emp_end and emp_start <= loc.custom_timestamp <= emp_end:
-            result.append(loc)
-    
-    return result
+    # Employees sharing a shift share a time window; each window becomes one
+    # index range condition, so the database returns only in-shift locations
+    windows = {}
+    for name, (start, end) in time_ranges.items():
+        windows.setdefault((start, end), []).append(name)
+
+    conditions = []
+    values = []
+    for (start, end), names in windows.items():
+        conditions.append("(employee IN %s AND custom_timestamp BETWEEN %s AND %s)")
+        values.extend([tuple(names), start, end])
+    values.append(HISTORICAL_PATH_MAX_ROWS)
+
+    # Fetch locations in one efficient query, each employee's path capped and thinned
+    # on its own so no employee's path is cut off by the others
+    locations = downsample_paths(frappe.db.sql(f"""
+        SELECT employee, latitude, longitude, custom_timestamp
+        FROM (
+            SELECT employee, latitude, longitude, custom_timestamp,
+                ROW_NUMBER() OVER (PARTITION BY employee ORDER BY custom_timestamp) AS position,
+                COUNT(*) OVER (PARTITION BY employee) AS points
+            FROM `tabLocation`
+            WHERE {" OR ".join(conditions)}
+        ) AS numbered
+        WHERE MOD(position - 1, CEIL(points / %s)) = 0 OR position = points
+        ORDER BY employee, custom_timestamp ASC
+    """, values, as_dict=True), step)
+    return paths_columns(locations) if cint(columnar) else locations
     
 # @frappe.whitelist(allow_guest=True)
 # def get_filtered_historical_paths(date, department=None, branch=None):
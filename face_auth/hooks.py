@@ -96,7 +96,8 @@ required_apps = ["hrms"]  # This ensures HRMS is installed
 # ------------
 
 # before_install = "face_auth.install.before_install"
-# after_install = "face_auth.install.after_install"
+after_install = "face_auth.install.after_install"
+after_migrate = "face_auth.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -158,9 +159,21 @@ required_apps = ["hrms"]  # This ensures HRMS is installed
 # 	}
 # }
 
+doc_events = {
+	"Employee": {
+		"on_update": "face_auth.api.face.clear_office_coordinates_cache",
+	}
+}
+
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"daily_long": [
+		"face_auth.tasks.purge_old_locations"
+	],
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"face_auth.tasks.all"
@@ -0,0 +1,53 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+
+def after_install():
+    create_face_auth_fields()
+    create_face_auth_indexes()
+
+
+def after_migrate():
+    create_face_auth_fields()
+    create_face_auth_indexes()
+
+
+def create_face_auth_fields():
+    """Fields face_auth stores on core doctypes"""
+    create_custom_fields(
+        {
+            "Employee": [
+                {
+                    "fieldname": "face_encoding",
+                    "label": "Face Encoding",
+                    "fieldtype": "Long Text",
+                    "hidden": 1,
+                    "read_only": 1,
+                    "no_copy": 1,
+                    "print_hide": 1,
+                    "description": "Base64 int8-quantized 128-D encoding of the registered face",
+                },
+                {
+                    "fieldname": "face_embedding",
+                    "label": "Face Embedding",
+                    "fieldtype": "Long Text",
+                    "hidden": 1,
+                    "read_only": 1,
+                    "no_copy": 1,
+                    "print_hide": 1,
+                    "description": "Base64 float32 embedding sent by the client (embedding_b64)",
+                },
+            ]
+        },
+        update=True,
+    )
+
+
+def create_face_auth_indexes():
+    """Indexes behind the per-employee attachment and location lookups of face_auth.api.face"""
+    # add_index is a no-op when an index of the same name already exists
+    frappe.db.add_index("File", ["attached_to_doctype", "attached_to_name"])
+    # Latest and historical location lookups per employee; both are custom fields
+    # on Location, so only once they exist
+    if frappe.db.has_column("Location", "employee") and frappe.db.has_column("Location", "custom_timestamp"):
+        frappe.db.add_index("Location", ["employee", "custom_timestamp"])
@@ -0,0 +1,12 @@
+import frappe
+
+from face_auth.install import create_face_auth_fields
+
+
+def execute():
+    # after_migrate only runs after the patches, so make sure face_encoding exists
+    create_face_auth_fields()
+
+    # Encode the reference images of employees registered before encodings were stored,
+    # so match_face never decodes a reference image; dlib is too slow to run inline here
+    frappe.enqueue("face_auth.api.face.backfill_reference_encodings", queue="long", enqueue_after_commit=True)
@@ -0,0 +1,76 @@
+import io
+
+import frappe
+from werkzeug.datastructures import FileStorage
+
+
+def create_checkin(employee_id, device_id, latitude, longitude, time, distance_from_office, confidence):
+    """
+    Creates the Employee Checkin for a successful face match.
+    Enqueued by match_face when `face_auth_background_checkin` is set.
+    """
+    from face_auth.api.face import insert_checkin
+
+    try:
+        insert_checkin(employee_id, device_id, latitude, longitude, time, distance_from_office, confidence)
+        frappe.db.commit()
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), "Checkin Creation Error")
+        raise
+
+
+def create_location(employee_id, latitude, longitude, timestamp):
+    """
+    Creates the Location log for a GPS ping.
+    Enqueued by track_location when `face_auth_background_location_tracking` is set.
+    """
+    from face_auth.api.face import insert_location
+
+    try:
+        insert_location(employee_id, latitude, longitude, timestamp)
+        frappe.db.commit()
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), "Location Tracking Failed")
+        raise
+
+
+def purge_old_locations():
+    """
+    Deletes tracking points older than `face_auth_location_retention_days` (site config),
+    one employee at a time so each DELETE is a range on the (employee, custom_timestamp)
+    index and stays a short transaction. Keeps everything when the setting is absent.
+    """
+    retention_days = frappe.utils.cint(frappe.conf.get("face_auth_location_retention_days"))
+    if retention_days <= 0:
+        return
+
+    cutoff = frappe.utils.add_days(frappe.utils.now_datetime(), -retention_days)
+    employees = frappe.db.sql_list("""
+        SELECT DISTINCT employee FROM `tabLocation` WHERE employee IS NOT NULL
+    """)
+    for employee in employees:
+        frappe.db.sql("""
+            DELETE FROM `tabLocation`
+            WHERE employee = %s AND custom_timestamp < %s
+        """, (employee, cutoff))
+        frappe.db.commit()
+
+
+def run_face_job(endpoint, form_dict, content, filename, job_key):
+    """
+    Runs a register_face/update_face request queued by enqueue_face_job and stores
+    its response for get_face_job_status.
+    """
+    from face_auth.api.face import FACE_JOB_RESULT_TTL, get_face_job_cache_key
+
+    frappe.local.form_dict = frappe._dict(form_dict)
+    frappe.local.face_auth_upload = FileStorage(io.BytesIO(content), filename=filename)
+    try:
+        result = frappe.get_attr(endpoint)()
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), "Face Job Error")
+        result = {"message": "failed"}
+    finally:
+        frappe.local.face_auth_upload = None
+
+    frappe.cache().set_value(get_face_job_cache_key(job_key), result, expires_in_sec=FACE_JOB_RESULT_TTL)
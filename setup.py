@@ -10,6 +10,12 @@ setup(
         "face-auth": [
             "dlib>=19.24.0",
             "face-recognition>=1.3.0"
+        ],
+        "opencv": [
+            "opencv-python-headless>=4.5.0"
+        ],
+        "simsimd": [
+            "simsimd>=3.0.0"
         ]
     }
 )
\ No newline at end of file